@@ -1,7 +1,22 @@
 #!/usr/bin/python3
-import requests
+import asyncio
+import httpx
 import base64
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import orjson
 import os
+import threading
+import time
+
+_HOME = os.path.expanduser('~')
+
+# httpx only speaks HTTP/2 with the optional h2 package (httpx[http2]), without it stay on HTTP/1.1
+try:
+    import h2
+    _HTTP2 = True
+except ImportError:
+    _HTTP2 = False
 
 class GitHubRepo:
     """
@@ -11,26 +26,57 @@ class GitHubRepo:
     """
 
     _apiBaseURL = "https://api.github.com/"
+    _graphqlURL = "https://api.github.com/graphql"
     masterFile = ".master"
     ref = "main"
     fileMode = "100644"
     directoryMode = "040000"
     branch = "main"
     emptyTreeSha = "4b825dc642cb6eb9a060e54bf8d69288fbee4904"
+    commitMessage = "Update registered files"
+    graphQLFallbackErrors = ("NOT_FOUND", "FORBIDDEN") # GraphQL unusable for this token/repo, use REST instead
+    uploadWorkers = 8
+    ioBufferSize = 1 << 19 # 512 KiB, cuts read/write syscalls on large files
+    streamBlobThreshold = 1 << 20 # blobs above 1 MiB are streamed instead of built as one JSON string
+    etagCacheFile = os.path.join(_HOME, ".githubsync_etags.json")
+    indexFile = os.path.join(_HOME, ".githubsync_index.json")
+    maxRetries = 5
+    retryBackoff = 0.5 # seconds, doubled on every retry
+    retryStatuses = (429, 502, 503, 504)
+    retryMethods = ("get", "put", "patch") # a POST (e.g. the GraphQL commit) may have gone through before the error
+    _rawMediaType = "application/vnd.github.raw"
+    _methods = {"get": "GET", "post": "POST", "put": "PUT", "patch": "PATCH"}
 
     def __init__(self, username, repoName, accessToken):
         self.username = username
         self.repoName = repoName
         self.accessToken = accessToken
         self.addedFiles = []
-        self.homeDir = os.path.expanduser('~')
+        self.homeDir = _HOME
+        self._defaultHeaders = {
+            "Accept": "application/vnd.github+json",
+            "Authorization": f"token {accessToken}"
+        }
+        self._client = self._createClient(self._defaultHeaders)
+        self._etagCache = self._loadCacheFile(self.etagCacheFile) # url -> {"etag", "lastModified", "body"}
+        self._etagCacheDirty = False
+        self._index = self._loadCacheFile(self.indexFile) # local path -> {"mtime", "size", "sha"}
+        self._indexTime = self._modifiedTime(self.indexFile)
+
+    @staticmethod
+    def _createClient(defaultHeaders, clientClass=httpx.Client, transportClass=httpx.HTTPTransport):
+        # one HTTP/2 client per repo, so every API call is multiplexed over the same TLS connection
+        limits = httpx.Limits(max_connections=20, max_keepalive_connections=20)
+        return clientClass(
+            http2=_HTTP2,
+            headers=defaultHeaders,
+            transport=transportClass(http2=_HTTP2, limits=limits, retries=GitHubRepo.maxRetries) # retries connection failures
+        )
     
     @staticmethod
     def createRemoteRepo(username, repoName, accessToken, repoDescription=""):
         url = GitHubRepo._apiBaseURL + f"user/repos"
-        requestHeader = {
-            "Authorization": f"token {accessToken}"
-        }
+        repo = GitHubRepo(username, repoName, accessToken)
 
         requestData = {
             "name": repoName,
@@ -38,34 +84,107 @@ class GitHubRepo:
             "auto_init": "true"
         }
 
-        res = requests.post(url, headers=requestHeader, json=requestData)
+        res = repo._client.post(url, json=requestData)
 
         if res.status_code == 201:
             # print(f"LOG: Created GitHubRepo {repoName} sucessfully")
-            return GitHubRepo(username, repoName, accessToken)
+            return repo
         else:
             raise Exception(f"Request to {url} receieved a {res.status_code} response and could not create the GitHub repo. Message = {res.json()}")
 
-    def _queryAPI(self, url, headers={}, json={}, method="get", wantJson=True):
-        headers.update({
-            "Accept": "application/vnd.github+json",
-            "Authorization": f"token {self.accessToken}"
-        })
+    @staticmethod
+    def _modifiedTime(path):
+        try:
+            return os.stat(path).st_mtime
+        except FileNotFoundError:
+            return 0
 
-        if method == "get":
-            res = requests.get(url, headers=headers, json=json)
+    @staticmethod
+    def _loadCacheFile(path):
+        try:
+            with open(path, 'rb') as cacheFile:
+                return orjson.loads(cacheFile.read())
+        except (FileNotFoundError, orjson.JSONDecodeError):
+            return {}
+
+    @staticmethod
+    def _saveCacheFile(path, data):
+        # the caches hold file contents, so keep them readable by the user only
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.fchmod(fd, 0o600)
+        with open(fd, 'wb') as cacheFile:
+            cacheFile.write(orjson.dumps(data))
+
+    def _saveEtagCache(self, registeredFiles):
+        # called once per readRemoteFiles/writeRemoteFiles, files that are no longer registered are dropped
+        keep = {self._contentsURL(path) for path in registeredFiles}
+        keep.add(self._contentsURL(self.masterFile))
+        for url in [url for url in self._etagCache if url not in keep]:
+            del self._etagCache[url]
+            self._etagCacheDirty = True
+
+        if self._etagCacheDirty:
+            self._saveCacheFile(self.etagCacheFile, self._etagCache)
+            self._etagCacheDirty = False
+
+    def _conditionalHeaders(self, url, headers):
+        cached = self._etagCache.get(url)
+        if cached == None:
+            return headers
+
+        headers = dict(headers or {})
+        if cached["etag"]:
+            headers["If-None-Match"] = cached["etag"]
+        elif cached["lastModified"]:
+            headers["If-Modified-Since"] = cached["lastModified"]
+        return headers
+
+    def _cachedBody(self, url, statusCode, responseHeaders, body):
+        # a 304 has an empty body and means the cached copy is still current
+        if statusCode == 304:
+            return self._etagCache[url]["body"]
+
+        if statusCode == 200 and (responseHeaders.get("ETag") or responseHeaders.get("Last-Modified")):
+            self._etagCache[url] = {
+                "etag": responseHeaders.get("ETag"),
+                "lastModified": responseHeaders.get("Last-Modified"),
+                "body": body
+            }
+            self._etagCacheDirty = True
+        return body
+
+    def _retryDelay(self, res, attempt):
+        retryAfter = res.headers.get("Retry-After")
+        if res.status_code == 429 and retryAfter and retryAfter.isdigit():
+            return int(retryAfter)
+        return self.retryBackoff * 2 ** attempt
+
+    def _queryAPI(self, url, headers=None, json=None, method="get", wantJson=True, cache=True, data=None):
+        httpMethod = self._methods.get(method)
+        if httpMethod == None:
+            raise Exception(f"{method} is not an implemented request method")
 
-        elif method == "post":
-            res = requests.post(url, json=json, headers=headers)
+        # only plain GETs are cached, anything mutating always goes to the API
+        cache = cache and method == "get" and wantJson
+        if cache:
+            headers = self._conditionalHeaders(url, headers)
 
-        elif method == "put":
-            res = requests.put(url, json=json, headers=headers)
+        # a data body (e.g. a streamed blob) takes precedence over json. orjson encodes the
+        # large base64 strings in blob payloads several times faster than the stdlib json module
+        body = data
+        if body == None and json != None:
+            headers = {**(headers or {}), "Content-Type": "application/json"}
+            body = orjson.dumps(json)
 
-        elif method == "patch":
-            res = requests.patch(url, headers=headers, json=json)
+        # Accept and Authorization already live on the client headers.
+        # A streamed body is consumed by the first attempt and can't be resent
+        retries = self.maxRetries if method in self.retryMethods and data == None else 0
+        for attempt in range(retries + 1):
+            res = self._client.request(httpMethod, url, headers=headers, content=body)
 
-        else:
-            raise Exception(f"{method} is not an implemented request method")
+            if res.status_code not in self.retryStatuses or attempt == retries:
+                break
+            time.sleep(self._retryDelay(res, attempt))
 
         # if res.status_code != 200:
             # raise Exception(f"Contents could not be retrieved. {res.status_code}, {res.text}, {url}")
@@ -74,35 +193,98 @@ class GitHubRepo:
 
         if wantJson == False:
             return res
+        elif cache:
+            return self._cachedBody(url, res.status_code, res.headers, orjson.loads(res.content) if res.status_code != 304 else None)
         else:
-            return res.json()
+            return orjson.loads(res.content)
 
     def _getPreviousCommit(self):
-        response = self._queryAPI(f"https://api.github.com/repos/{self.username}/{self.repoName}/git/refs/heads/{self.branch}", wantJson=False)
+        # the commit endpoint resolves the branch and carries the tree sha, so one call gives both
+        response = self._queryAPI(f"https://api.github.com/repos/{self.username}/{self.repoName}/commits/{self.branch}", wantJson=False)
         if response.status_code == 409:
-            return None
+            return None, None
         else:
-            return response.json()["object"]["sha"]
+            commit = orjson.loads(response.content)
+            return commit["sha"], commit["commit"]["tree"]["sha"]
 
-    def _getBranchTree(self, previousCommit, branch="main"):
-        url = f"https://api.github.com/repos/{self.username}/{self.repoName}/commits/{previousCommit}"
-        treeUrl = self._queryAPI(url)['commit']['tree']['url']
-        return self._queryAPI(treeUrl)['sha']
+    @staticmethod
+    def _streamBlobBody(content, chunkSize=3 << 16):
+        # base64 of whole 3 byte groups never pads, so each chunk can be encoded on its own
+        view = memoryview(content)
+        yield b'{"encoding": "base64", "content": "'
+        for start in range(0, len(view), chunkSize):
+            yield base64.b64encode(view[start:start + chunkSize])
+        yield b'"}'
 
     def _createNewBlob(self, content):
+        url = f"https://api.github.com/repos/{self.username}/{self.repoName}/git/blobs"
+
+        if len(content) > self.streamBlobThreshold:
+            response = self._queryAPI(url, headers={"Content-Type": "application/json"}, data=self._streamBlobBody(content), method="post")
+            return response["sha"]
+
         blob_data =  {
-            "content": base64.b64encode(content.encode()).decode(),
+            "content": base64.b64encode(content).decode('ascii'), # content is already bytes
             "encoding": "base64"
         }
 
-        headers = {
-            "Accept": "application/vnd.github+json",
-            "Authorization": f"token {self.accessToken}"
-        }
-
-        response = self._queryAPI(f"https://api.github.com/repos/{self.username}/{self.repoName}/git/blobs", json=blob_data, method="post")
+        response = self._queryAPI(url, json=blob_data, method="post")
         return response["sha"]
 
+    @staticmethod
+    def _gitBlobSha(content):
+        # same object id git computes, so it can be compared against the remote tree
+        return hashlib.sha1(b"blob %d\0%s" % (len(content), content)).hexdigest()
+
+    def _getRemoteBlobShas(self, treeSha):
+        url = f"https://api.github.com/repos/{self.username}/{self.repoName}/git/trees/{treeSha}?recursive=1"
+        # tree urls are content addressed, so a conditional request can never save anything.
+        # If GitHub truncates a huge tree the missing paths just look changed and get re-uploaded
+        tree = self._queryAPI(url, cache=False)["tree"]
+        return {entry["path"]: entry["sha"] for entry in tree if entry["type"] == "blob"}
+
+    def _localBlobSha(self, file):
+        # like git's index, trust the last sha while the file's mtime and size are unchanged. mtime and
+        # size come from the handle the contents were read from, so they always describe the hashed bytes.
+        # An entry whose mtime isn't older than the index itself is "racy" (the file may have changed again
+        # within the same timestamp) and is rehashed. Files without stat data (e.g. readRemoteFiles output)
+        # are simply hashed and left out of the index
+        if "mtime" not in file or "size" not in file:
+            return self._gitBlobSha(file["contents"])
+
+        entry = self._index.get(file["localPath"])
+        if entry != None and entry["mtime"] == file["mtime"] and entry["size"] == file["size"] and entry["mtime"] < self._indexTime:
+            return entry["sha"]
+
+        sha = self._gitBlobSha(file["contents"])
+        self._index[file["localPath"]] = {"mtime": file["mtime"], "size": file["size"], "sha": sha}
+        return sha
+
+    def _saveIndex(self, registeredFiles):
+        # drop paths that are no longer registered so the index can't grow forever
+        keep = {file.get("localPath") for file in registeredFiles.values()}
+        for localPath in [localPath for localPath in self._index if localPath not in keep]:
+            del self._index[localPath]
+
+        self._saveCacheFile(self.indexFile, self._index)
+        self._indexTime = self._modifiedTime(self.indexFile)
+
+    def _localBlobShas(self, registeredFiles, cancelled=None):
+        # cancelled is a threading.Event, it lets a caller stop hashing that runs in another thread
+        localShas = {}
+        for fileName, file in registeredFiles.items():
+            if cancelled != None and cancelled.is_set():
+                break
+            localShas[fileName] = self._localBlobSha(file)
+        return localShas
+
+    def _changedFiles(self, registeredFiles, remoteShas, localShas):
+        # unchanged files are already in base_tree, so they need neither a blob nor a tree entry
+        return {
+            fileName: file for fileName, file in registeredFiles.items()
+            if remoteShas.get(fileName) != localShas[fileName]
+        }
+
     def _createNewTreeBlob(self, path, fileType, sha): # should be self.fileMode or self.directoryMode
         return {
             "path": path,
@@ -147,15 +329,16 @@ class GitHubRepo:
         if force == True:
             reference_data["force"] = "true"
 
-        response = self._queryAPI(f"https://api.github.com/repos/{self.username}/{self.repoName}/git/refs/heads/{self.branch}", json=reference_data, method="patch")
+        url = f"https://api.github.com/repos/{self.username}/{self.repoName}/git/refs/heads/{self.branch}"
+        response = self._queryAPI(url, json=reference_data, method="patch", wantJson=False)
+        if response.status_code != 200:
+            raise Exception(f"Request to {url} receieved a {response.status_code} response and could not update {self.branch}. Message = {response.text}")
 
     def _createBranch(self, branchName="main"):
 
-        self._createFile(path=".master", branch=branchName) # this should create the branch
-
-        commitSha = self._commitTree(self.emptyTreeSha, None, message="Initial Commit")
-
-        self._updateBranchReference(commitSha)
+        # creating the first file creates the branch. Pointing it at a parentless empty commit afterwards
+        # is never a fast forward, so GitHub always rejected that update and it has been dropped
+        self._createFile(path=".master", branch=branchName)
 
     def _createFile(self, contents="", path="", message="", branch="main"):
         file_data = {
@@ -167,77 +350,440 @@ class GitHubRepo:
         response = self._queryAPI(f"https://api.github.com/repos/{self.username}/{self.repoName}/contents/{path}", json=file_data, method="put")
         return response["content"]["sha"]
 
-    def getFile(self, path):
-        url = self._apiBaseURL + f"repos/{self.username}/{self.repoName}/contents/{path}?ref={self.ref}"
+    def _contentsURL(self, path):
+        return self._apiBaseURL + f"repos/{self.username}/{self.repoName}/contents/{path}?ref={self.ref}"
+
+    def getFile(self, path, decode=True):
+        url = self._contentsURL(path)
         # url = f"https://raw.githubusercontent.com/{self.username}/GithubSync/refs/heads/main/{path}"
 
         jsonData = self._queryAPI(url)
 
         if isinstance(jsonData, list):
             raise Exception(f"{path} is a directory!")
+
+        # files over 1 MB have no inline content, writeLocalFiles streams those straight to disk
+        if jsonData['encoding'] == "none":
+            return None
     
-        return base64.b64decode(jsonData['content']).decode('utf-8')
+        contents = base64.b64decode(jsonData['content'])
+        return contents.decode('utf-8') if decode else contents
+
+    def _streamFile(self, path, localPath):
+        url = self._contentsURL(path)
+
+        with self._client.stream("GET", url, headers={"Accept": self._rawMediaType}) as res:
+            if res.status_code != 200:
+                raise Exception(f"Request to {url} receieved a {res.status_code} response and could not download {path}")
+
+            with open(localPath, 'wb', buffering=self.ioBufferSize) as localFile:
+                for chunk in res.iter_bytes(1 << 16):
+                    localFile.write(chunk)
 
     def readRemoteFiles(self):
         masterFile = self.getFile(f"{self.masterFile}").strip().split('\n')
         fileInfo = masterFile[1:]
         registeredFiles = {}
-        for i in range(len(fileInfo)):
-            temp = fileInfo[i].split()
-            registeredFiles[temp[0]] = {
-                "localPath": temp[2].replace('~', self.homeDir),
-                "contents": self.getFile(temp[0])
+        for line in fileInfo:
+            remote, _, local, *_ = line.split(None, 3)
+            registeredFiles[remote] = {
+                "localPath": os.path.expanduser(local),
+                "contents": self.getFile(remote, decode=False)
             }
+        self._saveEtagCache(registeredFiles)
         return registeredFiles
     
     def readLocalFiles(self):
-        masterFile = open(".master", "r")
-        fileInfo = masterFile.read().strip().split('\n')[1:]
-        masterFile.close()
         registeredFiles = {}
-        for i in range(len(fileInfo)):
-            if fileInfo[i].strip() == "":
-                continue
-            temp = fileInfo[i].split()
-            localPath = temp[2].replace('~', self.homeDir)
-            file = open(localPath, "r")
-            registeredFiles[temp[0]] = {
-                "localPath": localPath,
-                "contents": file.read()
-            }
-            file.close()
+        with open(self.masterFile, "r") as masterFile:
+            next(masterFile, None) # skip the [FILES] header
+            for line in masterFile:
+                if line.strip() == "":
+                    continue
+                remote, _, local, *_ = line.split(None, 3)
+                localPath = os.path.expanduser(local)
+                with open(localPath, "rb", buffering=self.ioBufferSize) as file:
+                    stat = os.fstat(file.fileno()) # before reading, so a later edit can only make the stat older
+                    registeredFiles[remote] = {
+                        "localPath": localPath,
+                        "mtime": stat.st_mtime,
+                        "size": stat.st_size,
+                        "contents": file.read()
+                    }
 
         return registeredFiles
 
     def writeLocalFiles(self, registeredFiles):
-        for file in registeredFiles.values():
-            currentFile = open(file['localPath'], 'w')
-            currentFile.write(file['contents'])
-            currentFile.close()
+        for fileName, file in registeredFiles.items():
+            if file['contents'] == None:
+                self._streamFile(fileName, file['localPath'])
+                continue
+
+            with open(file['localPath'], 'wb', buffering=self.ioBufferSize) as currentFile:
+                currentFile.write(file['contents'])
+
+    def registerFiles(self, registrations): # registrations should be a list of (remotePath, localPath, timestamp)
+        # one open and one write for the whole batch instead of one per file
+        with open(self.masterFile, 'a', buffering=1 << 16) as masterFile:
+            masterFile.write("".join(f"\n{remotePath} -> {localPath} - {timestamp}" for remotePath, localPath, timestamp in registrations))
 
     def registerFile(self, remotePath, localPath, timestamp=""):
-        with open(self.masterFile, 'a') as masterFile:
-            masterFile.write(f"\n{remotePath} -> {localPath} - {timestamp}")
+        self.registerFiles([(remotePath, localPath, timestamp)])
+
+    def _graphQLCommitData(self, registeredFiles, expectedHeadOid, message):
+        # createCommitOnBranch takes every file in one request instead of blob/tree/commit/ref calls
+        query = """
+        mutation ($input: CreateCommitOnBranchInput!) {
+            createCommitOnBranch(input: $input) {
+                commit { oid }
+            }
+        }"""
 
-    def writeRemoteFiles(self, registeredFiles):
-        newTreeBlobs = []
+        additions = []
         for fileName in registeredFiles:
-            newFileSha = self._createNewBlob(registeredFiles[fileName]["contents"])
-            newTreeBlobs.append(self._createNewTreeBlob(fileName, GitHubRepo.fileMode, newFileSha))
+            additions.append({
+                "path": fileName,
+                "contents": base64.b64encode(registeredFiles[fileName]["contents"]).decode('ascii')
+            })
 
-        previousCommitSha = self._getPreviousCommit()
+        return {
+            "query": query,
+            "variables": {
+                "input": {
+                    "branch": {
+                        "repositoryNameWithOwner": f"{self.username}/{self.repoName}",
+                        "branchName": self.branch
+                    },
+                    "message": {"headline": message},
+                    "fileChanges": {"additions": additions},
+                    "expectedHeadOid": expectedHeadOid
+                }
+            }
+        }
+
+    def _graphQLCommitOid(self, res):
+        # None only when GraphQL can't be used at all, then the REST chain takes over. Any other error
+        # (e.g. STALE_DATA when expectedHeadOid no longer matches) has to reach the user, because the REST
+        # chain would build on the same stale parent
+        if res.status_code != 200:
+            return None
+
+        response = orjson.loads(res.content)
+        errors = response.get("errors")
+        result = (response.get("data") or {}).get("createCommitOnBranch")
+        if not errors:
+            return result["commit"]["oid"]
+
+        messages = "; ".join(error.get("message", "") for error in errors)
+        if result != None:
+            raise Exception(f"GraphQL commit to {self.branch} returned a partial result, check the remote before retrying. Errors = {messages}")
+        if any(error.get("type") == "STALE_DATA" for error in errors):
+            raise Exception(f"{self.branch} changed on GitHub since it was read, download the files before uploading again. Errors = {messages}")
+        if all(error.get("type") in self.graphQLFallbackErrors for error in errors):
+            return None
+        raise Exception(f"GraphQL commit to {self.branch} failed. Errors = {messages}")
+
+    def _commitFilesGraphQL(self, registeredFiles, expectedHeadOid, message):
+        commit_data = self._graphQLCommitData(registeredFiles, expectedHeadOid, message)
+        return self._graphQLCommitOid(self._queryAPI(self._graphqlURL, json=commit_data, method="post", wantJson=False))
+
+    def _getRemoteState(self):
+        # read only, so it is safe to start before the rate limit has been checked
+        previousCommitSha, currentTreeSha = self._getPreviousCommit()
+        if previousCommitSha == None:
+            return None, None, {}
+        return previousCommitSha, currentTreeSha, self._getRemoteBlobShas(currentTreeSha)
+
+    def writeRemoteFiles(self, registeredFiles):
+        # the rate limit check and remote lookups only need the API, so they run in the background
+        # while the local files are hashed and are joined once their results are needed
+        executor = ThreadPoolExecutor(max_workers=2)
+        try:
+            rateLimits = executor.submit(self._checkRateLimits)
+            remoteState = executor.submit(self._getRemoteState)
+            localShas = self._localBlobShas(registeredFiles)
+            self._checkRemainingRequests(rateLimits.result())
+            previousCommitSha, currentTreeSha, remoteShas = remoteState.result()
+        finally:
+            # don't wait on the lookups when the rate limit check fails
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        # anything that writes to the remote only happens once the rate limit check passed
         if previousCommitSha == None:
             self._createBranch()
-            previousCommitSha = self._getPreviousCommit()
-            # newTreeSha = self._createTree(newTreeBlobs)
-        currentTreeSha = self._getBranchTree(previousCommitSha)
+            previousCommitSha, currentTreeSha = self._getPreviousCommit()
+
+        changedFiles = self._changedFiles(registeredFiles, remoteShas, localShas)
+        if changedFiles:
+            self._commitFiles(changedFiles, previousCommitSha, currentTreeSha)
+
+        # only persist the local shas once the upload went through
+        self._saveIndex(registeredFiles)
+        self._saveEtagCache(registeredFiles)
+
+    def _hasLargeFiles(self, registeredFiles):
+        # GraphQL needs every file inlined as one base64 string, large ones are streamed as REST blobs instead
+        return any(len(file["contents"]) > self.streamBlobThreshold for file in registeredFiles.values())
+
+    def _commitFiles(self, registeredFiles, previousCommitSha, currentTreeSha, message=commitMessage):
+        # both paths get the same message so a commit looks the same whichever one made it
+        if not self._hasLargeFiles(registeredFiles) and self._commitFilesGraphQL(registeredFiles, previousCommitSha, message) != None:
+            return
+
+        # large files or GraphQL isn't available, use the REST blob -> tree -> commit -> ref chain.
+        # Blob uploads are independent so they run on a thread pool sharing the client's connections,
+        # map() keeps the results in registeredFiles order
+        with ThreadPoolExecutor(max_workers=self.uploadWorkers) as executor:
+            newFileShas = executor.map(lambda file: self._createNewBlob(file["contents"]), registeredFiles.values())
+            newTreeBlobs = [self._createNewTreeBlob(fileName, GitHubRepo.fileMode, newFileSha) for fileName, newFileSha in zip(registeredFiles, newFileShas)]
+
         newTreeSha = self._updateTree(currentTreeSha, newTreeBlobs)
         
-        newCommitSha = self._commitTree(newTreeSha, previousCommitSha)
+        newCommitSha = self._commitTree(newTreeSha, previousCommitSha, message)
         self._updateBranchReference(newCommitSha)
 
     def _checkRateLimits(self):
-        return self._queryAPI("https://api.github.com/rate_limit")
+        return self._queryAPI("https://api.github.com/rate_limit", cache=False)
+
+    def _checkRemainingRequests(self, rateLimits):
+        core = rateLimits["resources"]["core"]
+        if core["remaining"] == 0:
+            raise Exception(f"GitHub API rate limit exhausted, it resets at {time.ctime(core['reset'])}")
+
+class AsyncGitHubRepo(GitHubRepo):
+    """
+    asyncio version of GitHubRepo. Remote reads and blob uploads are issued concurrently
+    instead of one after another, multiplexed over a single HTTP/2 connection. Must be
+    used as an async context manager so the client lives inside the running event loop:
+
+        async with AsyncGitHubRepo(username, repoName, accessToken) as repo:
+            remoteFiles = await repo.readRemoteFiles()
+    """
+
+    maxConcurrentRequests = 10 # stay under GitHub's secondary rate limit
+    _semaphore = None
+
+    @staticmethod
+    def _createClient(defaultHeaders):
+        # the async client has to be created inside the running event loop, see __aenter__
+        return None
+
+    async def __aenter__(self):
+        self._client = GitHubRepo._createClient(self._defaultHeaders, httpx.AsyncClient, httpx.AsyncHTTPTransport)
+        self._semaphore = asyncio.Semaphore(self.maxConcurrentRequests)
+        return self
+
+    async def __aexit__(self, *exc):
+        await self._client.aclose()
+
+    async def _queryAPI(self, url, headers=None, json=None, method="get", wantJson=True, cache=True, data=None):
+        httpMethod = self._methods.get(method)
+        if httpMethod == None:
+            raise Exception(f"{method} is not an implemented request method")
+
+        cache = cache and method == "get" and wantJson
+        if cache:
+            headers = self._conditionalHeaders(url, headers)
+
+        body = data
+        if body == None and json != None:
+            headers = {**(headers or {}), "Content-Type": "application/json"}
+            body = orjson.dumps(json)
+
+        retries = self.maxRetries if method in self.retryMethods and data == None else 0
+        for attempt in range(retries + 1):
+            async with self._semaphore:
+                res = await self._client.request(httpMethod, url, headers=headers, content=body)
+
+            if res.status_code not in self.retryStatuses or attempt == retries:
+                break
+            await asyncio.sleep(self._retryDelay(res, attempt))
+
+        if wantJson == False:
+            return res
+        elif cache:
+            return self._cachedBody(url, res.status_code, res.headers, orjson.loads(res.content) if res.status_code != 304 else None)
+        else:
+            return orjson.loads(res.content)
+
+    async def _getPreviousCommit(self):
+        response = await self._queryAPI(f"https://api.github.com/repos/{self.username}/{self.repoName}/commits/{self.branch}", wantJson=False)
+        if response.status_code == 409:
+            return None, None
+        else:
+            commit = orjson.loads(response.content)
+            return commit["sha"], commit["commit"]["tree"]["sha"]
+
+    @staticmethod
+    async def _asyncStreamBlobBody(content):
+        # AsyncClient only streams async iterables
+        for chunk in GitHubRepo._streamBlobBody(content):
+            yield chunk
+
+    async def _createNewBlob(self, content):
+        url = f"https://api.github.com/repos/{self.username}/{self.repoName}/git/blobs"
+
+        if len(content) > self.streamBlobThreshold:
+            response = await self._queryAPI(url, headers={"Content-Type": "application/json"}, data=self._asyncStreamBlobBody(content), method="post")
+            return response["sha"]
+
+        blob_data =  {
+            "content": base64.b64encode(content).decode('ascii'), # content is already bytes
+            "encoding": "base64"
+        }
+
+        response = await self._queryAPI(url, json=blob_data, method="post")
+        return response["sha"]
+
+    async def _createTree(self, blobs):
+        tree_data = {
+            "tree": blobs
+        }
+
+        response = await self._queryAPI(f"https://api.github.com/repos/{self.username}/{self.repoName}/git/trees", json=tree_data, method="post")
+        return response["sha"]
+
+    async def _updateTree(self, treeSha, newBlobs):
+        tree_data = {
+            "base_tree": treeSha,
+            "tree": newBlobs
+        }
+
+        response = await self._queryAPI(f"https://api.github.com/repos/{self.username}/{self.repoName}/git/trees", json=tree_data, method="post")
+        return response["sha"]
+
+    async def _commitTree(self, treeSha, previousCommitSha, message=""):
+        commit_data = {
+            "message": message,
+            "tree": treeSha,
+        }
+        if previousCommitSha != None:
+            commit_data["parents"] = [previousCommitSha]
+
+        response = await self._queryAPI(f"https://api.github.com/repos/{self.username}/{self.repoName}/git/commits", json=commit_data, method="post")
+        return response["sha"]
+
+    async def _updateBranchReference(self, commitSha, force=False):
+        reference_data = {
+            "sha": commitSha,
+        }
+
+        if force == True:
+            reference_data["force"] = "true"
+
+        url = f"https://api.github.com/repos/{self.username}/{self.repoName}/git/refs/heads/{self.branch}"
+        response = await self._queryAPI(url, json=reference_data, method="patch", wantJson=False)
+        if response.status_code != 200:
+            raise Exception(f"Request to {url} receieved a {response.status_code} response and could not update {self.branch}. Message = {response.text}")
+
+    async def _createBranch(self, branchName="main"):
+        await self._createFile(path=".master", branch=branchName)
+
+    async def _createFile(self, contents="", path="", message="", branch="main"):
+        file_data = {
+            "branch": branch,
+            "message": message,
+            "content": base64.b64encode(contents.encode()).decode()
+        }
+
+        response = await self._queryAPI(f"https://api.github.com/repos/{self.username}/{self.repoName}/contents/{path}", json=file_data, method="put")
+        return response["content"]["sha"]
+
+    async def getFile(self, path, decode=True):
+        url = self._contentsURL(path)
+
+        jsonData = await self._queryAPI(url)
+
+        if isinstance(jsonData, list):
+            raise Exception(f"{path} is a directory!")
+
+        # files over 1 MB have no inline content, fetch the raw bytes instead of base64 JSON
+        if jsonData['encoding'] == "none":
+            res = await self._queryAPI(url, headers={"Accept": self._rawMediaType}, wantJson=False)
+            if res.status_code != 200:
+                raise Exception(f"Request to {url} receieved a {res.status_code} response and could not download {path}")
+            contents = res.content
+        else:
+            contents = base64.b64decode(jsonData['content'])
+        return contents.decode('utf-8') if decode else contents
+
+    async def readRemoteFiles(self):
+        masterFile = (await self.getFile(f"{self.masterFile}")).strip().split('\n')
+        fileInfo = [line.split(None, 3) for line in masterFile[1:]]
+        contents = await asyncio.gather(*(self.getFile(remote, decode=False) for remote, *_ in fileInfo))
+
+        registeredFiles = {}
+        for (remote, _, local, *_), fileContents in zip(fileInfo, contents):
+            registeredFiles[remote] = {
+                "localPath": os.path.expanduser(local),
+                "contents": fileContents
+            }
+        await asyncio.to_thread(self._saveEtagCache, registeredFiles)
+        return registeredFiles
+
+    async def _getRemoteBlobShas(self, treeSha):
+        url = f"https://api.github.com/repos/{self.username}/{self.repoName}/git/trees/{treeSha}?recursive=1"
+        tree = (await self._queryAPI(url, cache=False))["tree"]
+        return {entry["path"]: entry["sha"] for entry in tree if entry["type"] == "blob"}
+
+    async def _getRemoteState(self):
+        previousCommitSha, currentTreeSha = await self._getPreviousCommit()
+        if previousCommitSha == None:
+            return None, None, {}
+        return previousCommitSha, currentTreeSha, await self._getRemoteBlobShas(currentTreeSha)
+
+    async def writeRemoteFiles(self, registeredFiles):
+        # hashing runs in a thread so it overlaps with the rate limit check and the read only remote lookups
+        cancelHashing = threading.Event()
+        remoteState = asyncio.create_task(self._getRemoteState())
+        localShas = asyncio.create_task(asyncio.to_thread(self._localBlobShas, registeredFiles, cancelHashing))
+        try:
+            self._checkRemainingRequests(await self._checkRateLimits())
+            (previousCommitSha, currentTreeSha, remoteShas), localShas = await asyncio.gather(remoteState, localShas)
+        except BaseException:
+            # stop the background work and collect its outcome, so a failed task isn't left unretrieved
+            cancelHashing.set()
+            remoteState.cancel()
+            localShas.cancel()
+            await asyncio.gather(remoteState, localShas, return_exceptions=True)
+            raise
+
+        if previousCommitSha == None:
+            await self._createBranch()
+            previousCommitSha, currentTreeSha = await self._getPreviousCommit()
+
+        changedFiles = self._changedFiles(registeredFiles, remoteShas, localShas)
+        if changedFiles:
+            await self._commitFiles(changedFiles, previousCommitSha, currentTreeSha)
+
+        self._saveIndex(registeredFiles)
+        await asyncio.to_thread(self._saveEtagCache, registeredFiles)
+
+    async def _commitFilesGraphQL(self, registeredFiles, expectedHeadOid, message):
+        commit_data = self._graphQLCommitData(registeredFiles, expectedHeadOid, message)
+        return self._graphQLCommitOid(await self._queryAPI(self._graphqlURL, json=commit_data, method="post", wantJson=False))
+
+    async def _commitFiles(self, registeredFiles, previousCommitSha, currentTreeSha, message=GitHubRepo.commitMessage):
+        if not self._hasLargeFiles(registeredFiles) and await self._commitFilesGraphQL(registeredFiles, previousCommitSha, message) != None:
+            return
+
+        # blobs are independent of each other so upload them all at once,
+        # only the tree -> commit -> ref chain has to stay sequential
+        fileNames = list(registeredFiles)
+        blobShas = await asyncio.gather(*(self._createNewBlob(registeredFiles[fileName]["contents"]) for fileName in fileNames))
+        newTreeBlobs = [self._createNewTreeBlob(fileName, GitHubRepo.fileMode, sha) for fileName, sha in zip(fileNames, blobShas)]
+
+        newTreeSha = await self._updateTree(currentTreeSha, newTreeBlobs)
+
+        newCommitSha = await self._commitTree(newTreeSha, previousCommitSha, message)
+        await self._updateBranchReference(newCommitSha)
+
+    def _streamFile(self, path, localPath):
+        # getFile here always returns the contents, so writeLocalFiles never needs to stream
+        raise Exception("AsyncGitHubRepo can't stream files synchronously, use getFile instead")
+
+    async def _checkRateLimits(self):
+        return await self._queryAPI("https://api.github.com/rate_limit", cache=False)
 
 def configureAccessTokens():
     while True:
@@ -280,7 +826,7 @@ def connectToGitHubRepo():
     repo = GitHubRepo(username, repoName, accessToken)
     print("Connecting to your github repository!")
     
-    res = requests.get(f"https://api.github.com/repos/{username}/{repoName}")
+    res = repo._client.get(f"https://api.github.com/repos/{username}/{repoName}")
 
     if res.status_code == 200:
         print("Connection success!")
@@ -349,24 +895,24 @@ def deregisterFile(repository):
         if fileName == "exit" or fileName == "back":
             break
 
-        with open(repository.masterFile, 'r+') as masterFile:
-            lines = masterFile.readlines()
-
-            for i in range(len(lines)):
-                if lines[i].split()[0] == fileName:
-                    lines.pop(i)
+        # stream into a sibling file and swap it in, instead of rewriting .master in place
+        tempPath = repository.masterFile + ".tmp"
+        with open(repository.masterFile, 'r') as masterFile, open(tempPath, 'w', buffering=1 << 16) as tempFile:
+            for line in masterFile:
+                if line.partition(' ')[0] == fileName:
                     break
+                tempFile.write(line)
+            tempFile.writelines(masterFile) # everything after the match is copied as is
 
-            masterFile.seek(0)
-            masterFile.writelines(lines)
-            masterFile.truncate()
-            print("Successfully deregistered file!")
-            break
+        os.replace(tempPath, repository.masterFile)
+        print("Successfully deregistered file!")
+        break
 
 def displayRegisteredFiles(repository):
     with open(repository.masterFile, "r") as masterFile:
         print("Remote Name\tLocal Path")
-        for line in masterFile.readlines()[1:]:
+        next(masterFile, None) # skip the [FILES] header
+        for line in masterFile:
             print(line.strip())
 
 def createNewRepo():
@@ -418,4 +964,4 @@ if __name__ == "__main__":
         try:
             main()
         except Exception as e:
-            print(f"An error occurred. Restarting!")
\ No newline at end of file
+            print(f"An error occurred ({e}). Restarting!")
\ No newline at end of file